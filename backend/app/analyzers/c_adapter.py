@@ -1,19 +1,19 @@
 from __future__ import annotations
 
+import logging
+import os
 import re
-from dataclasses import dataclass, asdict
-from typing import Any
+import threading
+from typing import Any, Optional
 
 from app.schemas import HintRequest
 
+logger = logging.getLogger(__name__)
 
-@dataclass
-class AnalysisResult:
-    language: str
-    cluster_key: str
-    hint_type: str
-    confidence: float
-    signals: dict[str, Any]
+# Feature dicts kept per source_hash; resubmitting identical code is common in training.
+FEATURE_CACHE_SIZE = 4096
+
+_NULL_CHECK_RX = re.compile(r"if\s*\([^\)]*==\s*null|if\s*\([^\)]*!\s*\w+\)", re.I)
 
 
 class CAdapter:
@@ -24,99 +24,93 @@ class CAdapter:
 
     # Compile patterns worth tutoring (not pure syntax punctuation).
     COMPILE_PATTERNS = [
-        (r"undeclared(?:\s+identifier)?|was not declared|implicit declaration", "c_undeclared_identifier", "compile_symbol", 0.92),
-        (r"conflicting types for|incompatible type|incompatible pointer type", "c_type_mismatch", "types", 0.9),
-        (r"too (?:few|many) arguments to function|passing argument .* from incompatible pointer type", "c_parameter_mismatch", "signature", 0.9),
-        (r"conflicting types for .*|previous declaration of .* with type", "c_prototype_conflict", "prototype", 0.9),
-        (r"return type .* is not compatible|return makes .* from .* without a cast", "c_return_type_mismatch", "return_type", 0.86),
-        (r"subscripted value is neither array nor pointer|invalid type argument of unary \*", "c_pointer_deref_misuse", "pointers", 0.88),
-        (r"free\(|invalid conversion .*free", "c_free_misuse_compile", "memory", 0.76),
-        (r"warning: unused variable", "c_warning_unused_variable", "warning_unused", 0.55),
+        (re.compile(r"undeclared(?:\s+identifier)?|was not declared|implicit declaration", re.I | re.S), "c_undeclared_identifier", "compile_symbol", 0.92),
+        (re.compile(r"conflicting types for|incompatible type|incompatible pointer type", re.I | re.S), "c_type_mismatch", "types", 0.9),
+        (re.compile(r"too (?:few|many) arguments to function|passing argument .* from incompatible pointer type", re.I | re.S), "c_parameter_mismatch", "signature", 0.9),
+        (re.compile(r"conflicting types for .*|previous declaration of .* with type", re.I | re.S), "c_prototype_conflict", "prototype", 0.9),
+        (re.compile(r"return type .* is not compatible|return makes .* from .* without a cast", re.I | re.S), "c_return_type_mismatch", "return_type", 0.86),
+        (re.compile(r"subscripted value is neither array nor pointer|invalid type argument of unary \*", re.I | re.S), "c_pointer_deref_misuse", "pointers", 0.88),
+        (re.compile(r"free\(|invalid conversion .*free", re.I | re.S), "c_free_misuse_compile", "memory", 0.76),
+        (re.compile(r"warning: unused variable", re.I | re.S), "c_warning_unused_variable", "warning_unused", 0.55),
     ]
 
     RUNTIME_PATTERNS = [
-        (r"segmentation fault|sigsegv", "c_segfault", "runtime_memory", 0.95),
-        (r"addresssanitizer.*heap-use-after-free|use-after-free", "c_use_after_free", "memory", 0.98),
-        (r"addresssanitizer.*double-free|double free", "c_double_free", "memory", 0.98),
-        (r"addresssanitizer.*invalid free|free\(\): invalid pointer", "c_invalid_free", "memory", 0.97),
-        (r"stack-buffer-overflow|heap-buffer-overflow|out of bounds", "c_out_of_bounds", "bounds", 0.94),
-        (r"null pointer|dereference of null|addresssanitizer.*null", "c_null_dereference", "pointers", 0.92),
+        (re.compile(r"segmentation fault|sigsegv", re.I | re.S), "c_segfault", "runtime_memory", 0.95),
+        (re.compile(r"addresssanitizer.*heap-use-after-free|use-after-free", re.I | re.S), "c_use_after_free", "memory", 0.98),
+        (re.compile(r"addresssanitizer.*double-free|double free", re.I | re.S), "c_double_free", "memory", 0.98),
+        (re.compile(r"addresssanitizer.*invalid free|free\(\): invalid pointer", re.I | re.S), "c_invalid_free", "memory", 0.97),
+        (re.compile(r"stack-buffer-overflow|heap-buffer-overflow|out of bounds", re.I | re.S), "c_out_of_bounds", "bounds", 0.94),
+        (re.compile(r"null pointer|dereference of null|addresssanitizer.*null", re.I | re.S), "c_null_dereference", "pointers", 0.92),
+    ]
+
+    # Case-limit keywords in failed test names/output (Italian + English), checked in priority order.
+    FAILED_TEST_KEYWORDS = [
+        (("empty", "vuoto", "n=0", "zero"), "c_logic_edge_case_empty", "edge_case", 0.8),
+        (("single", "uno", "1 elemento", "one element"), "c_logic_edge_case_single", "edge_case", 0.76),
+        (("format", "output", "newline", "spazio", "space"), "c_output_format", "output_format", 0.75),
+        (("bounds", "index", "ultimo", "last", "first"), "c_logic_bounds_off_by_one", "bounds", 0.79),
     ]
 
+    def __init__(self) -> None:
+        self._features_cache: dict[str, dict[str, bool | int]] = {}
+        self._features_lock = threading.Lock()
+        # Signal collection is for debugging only; skip it on the normal path.
+        self._debug = bool(os.getenv("HINT_ENGINE_DEBUG"))
+
+    def analyze(self, req: HintRequest, source_hash: Optional[str] = None) -> tuple[str, str, float]:
+        """Classify a submission; returns ``(cluster_key, hint_type, confidence)``."""
+        result = self._classify(req, source_hash)
+        if self._debug:
+            cr = req.coderunner
+            signals: dict[str, Any] = {
+                "code_features": self._code_features(req.source_code or "", source_hash),
+                "score_ratio": self._safe_ratio(cr.score, cr.max_score),
+            }
+            logger.debug("c analysis %s signals=%s", result, signals)
+        return result
+
     # Logic heuristics from failed tests / code shape / feedback text.
-    def analyze(self, req: HintRequest) -> AnalysisResult:
-        code = req.source_code or ""
+    def _classify(self, req: HintRequest, source_hash: Optional[str]) -> tuple[str, str, float]:
         cr = req.coderunner
         compile_text = (cr.compile_error_text or "")
         runtime_text = (cr.runtime_error_text or "")
         full_text = (cr.full_feedback_text or "")
         failed_tests = cr.failed_tests or []
 
-        merged_compile = (compile_text + "\n" + full_text).lower()
-        merged_runtime = (runtime_text + "\n" + full_text).lower()
-        failed_join = "\n".join(failed_tests).lower()
-
-        signals: dict[str, Any] = {
-            "compile_patterns": [],
-            "runtime_patterns": [],
-            "failed_test_cues": [],
-            "code_features": self._extract_code_features(code),
-            "score_ratio": self._safe_ratio(cr.score, cr.max_score),
-        }
+        score_ratio = self._safe_ratio(cr.score, cr.max_score)
 
         # 1) Runtime memory issues first.
-        for pat, cluster, hint_type, conf in self.RUNTIME_PATTERNS:
-            if re.search(pat, merged_runtime, flags=re.I | re.S):
-                signals["runtime_patterns"].append(cluster)
-                return AnalysisResult(
-                    language="c",
-                    cluster_key=cluster,
-                    hint_type=hint_type,
-                    confidence=conf,
-                    signals=signals,
-                )
+        # Patterns are case-insensitive and each source is searched as-is: no lowercased or merged copies.
+        for rx, cluster, hint_type, conf in self.RUNTIME_PATTERNS:
+            if rx.search(runtime_text) or rx.search(full_text):
+                return cluster, hint_type, conf
 
         # 2) Compile but conceptually useful.
-        for pat, cluster, hint_type, conf in self.COMPILE_PATTERNS:
-            if re.search(pat, merged_compile, flags=re.I | re.S):
-                signals["compile_patterns"].append(cluster)
+        for rx, cluster, hint_type, conf in self.COMPILE_PATTERNS:
+            if rx.search(compile_text) or rx.search(full_text):
                 # De-prioritize pure warning-only situations when score is already full.
-                if cluster == "c_warning_unused_variable" and signals["score_ratio"] >= 0.99:
+                if cluster == "c_warning_unused_variable" and score_ratio >= 0.99:
                     break
-                return AnalysisResult(
-                    language="c",
-                    cluster_key=cluster,
-                    hint_type=hint_type,
-                    confidence=conf,
-                    signals=signals,
-                )
+                return cluster, hint_type, conf
 
         # 3) Logic/case-limit cues from failed tests.
+        failed_join = "\n".join(failed_tests).lower()
         if failed_join:
-            if any(k in failed_join for k in ["empty", "vuoto", "n=0", "zero"]):
-                signals["failed_test_cues"].append("edge_case_empty")
-                return AnalysisResult("c", "c_logic_edge_case_empty", "edge_case", 0.8, signals)
-            if any(k in failed_join for k in ["single", "uno", "1 elemento", "one element"]):
-                signals["failed_test_cues"].append("edge_case_single")
-                return AnalysisResult("c", "c_logic_edge_case_single", "edge_case", 0.76, signals)
-            if any(k in failed_join for k in ["format", "output", "newline", "spazio", "space"]):
-                signals["failed_test_cues"].append("output_format")
-                return AnalysisResult("c", "c_output_format", "output_format", 0.75, signals)
-            if any(k in failed_join for k in ["bounds", "index", "ultimo", "last", "first"]):
-                signals["failed_test_cues"].append("bounds")
-                return AnalysisResult("c", "c_logic_bounds_off_by_one", "bounds", 0.79, signals)
+            for keywords, cluster, hint_type, conf in self.FAILED_TEST_KEYWORDS:
+                if any(k in failed_join for k in keywords):
+                    return cluster, hint_type, conf
 
         # 4) Code-structure hints when tests fail but messages are generic.
-        if signals["score_ratio"] < 0.99:
-            feats = signals["code_features"]
+        if score_ratio < 0.99:
+            feats = self._code_features(req.source_code or "", source_hash)
             if feats.get("uses_free") and not feats.get("null_check_after_malloc") and feats.get("uses_malloc"):
-                return AnalysisResult("c", "c_memory_malloc_no_null_check", "memory", 0.62, signals)
+                return "c_memory_malloc_no_null_check", "memory", 0.62
             if feats.get("has_for_loop") and feats.get("uses_array_index"):
-                return AnalysisResult("c", "c_logic_loop_bounds_generic", "logic_loop", 0.58, signals)
-            return AnalysisResult("c", "c_logic_generic_failed_tests", "logic_generic", 0.45, signals)
+                return "c_logic_loop_bounds_generic", "logic_loop", 0.58
+            return "c_logic_generic_failed_tests", "logic_generic", 0.45
 
         # 5) Full score or no useful signal.
-        return AnalysisResult("c", "c_no_hint_needed", "none", 0.2, signals)
+        return "c_no_hint_needed", "none", 0.2
 
     def _safe_ratio(self, score: float, max_score: float) -> float:
         try:
@@ -126,13 +120,33 @@ class CAdapter:
         except Exception:
             return 0.0
 
+    def _code_features(self, code: str, source_hash: Optional[str]) -> dict[str, bool | int]:
+        if source_hash is None:
+            return self._extract_code_features(code)
+        feats = self._features_cache.get(source_hash)
+        if feats is None:
+            feats = self._extract_code_features(code)
+            with self._features_lock:
+                if len(self._features_cache) >= FEATURE_CACHE_SIZE:
+                    # Dicts keep insertion order: drop the oldest entry.
+                    del self._features_cache[next(iter(self._features_cache))]
+                self._features_cache[source_hash] = feats
+        return feats
+
     def _extract_code_features(self, code: str) -> dict[str, bool | int]:
-        code_l = code.lower()
-        # Extremely lightweight and cheap: no AST yet.
+        # Extremely lightweight and cheap: no AST yet. Substring checks run in C.
+        uses_malloc = "malloc(" in code
+        uses_free = "free(" in code
+        if not (uses_malloc and uses_free):
+            # Case-insensitive tokens: lowercase only when the exact-case check misses.
+            code_l = code.lower()
+            uses_malloc = uses_malloc or "malloc(" in code_l
+            uses_free = uses_free or "free(" in code_l
         return {
-            "uses_malloc": "malloc(" in code_l,
-            "uses_free": "free(" in code_l,
-            "null_check_after_malloc": bool(re.search(r"if\s*\([^\)]*==\s*null|if\s*\([^\)]*!\s*\w+\)", code_l)),
+            "uses_malloc": uses_malloc,
+            "uses_free": uses_free,
+            # Only meaningful (and only consulted) when malloc is present.
+            "null_check_after_malloc": uses_malloc and bool(_NULL_CHECK_RX.search(code)),
             "has_for_loop": "for (" in code or "for(" in code,
             "has_while_loop": "while (" in code or "while(" in code,
             "uses_array_index": "[" in code and "]" in code,
@@ -1,140 +1,222 @@
 from __future__ import annotations
 
-import json
 import sqlite3
+import threading
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Optional
+from typing import Any, Iterator, Optional
+
+import orjson
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 DATA_DIR = BASE_DIR / 'data'
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 DB_PATH = DATA_DIR / 'hint_engine.sqlite3'
 
+# One long-lived connection per thread (FastAPI runs sync endpoints on a worker pool).
+_LOCAL = threading.local()
+
+# Columns written by insert_attempt, in bind order.
+ATTEMPT_COLUMNS = (
+    'mode', 'language', 'course_id', 'quiz_id', 'question_id', 'question_slot', 'question_name',
+    'student_id', 'attempt_id', 'attempt_no', 'source_code', 'source_hash', 'score', 'max_score',
+    'compile_error_text', 'runtime_error_text', 'failed_tests_json', 'full_feedback_text',
+    'cluster_key', 'hint_level', 'hint_type', 'hint_variant', 'hint_text', 'confidence',
+)
+_ATTEMPT_COLUMN_SET = frozenset(ATTEMPT_COLUMNS)
+
+# Derived per-row success rate, kept as a generated column instead of being computed per query.
+_IMPROVE_RATE_COLUMN = (
+    'improve_rate REAL GENERATED ALWAYS AS '
+    '(ROUND(CAST(improvements AS REAL) / CASE WHEN exposures = 0 THEN 1 ELSE exposures END, 3)) VIRTUAL'
+)
+
+# Fixed SQL text so sqlite3's per-connection statement cache reuses the prepared statements.
+_SQL_INSERT_ATTEMPT = (
+    f"INSERT INTO attempts ({', '.join(ATTEMPT_COLUMNS)}) "
+    f"VALUES ({', '.join('?' for _ in ATTEMPT_COLUMNS)})"
+)
+
+_SQL_GET_LAST_ATTEMPT = '''
+    SELECT * FROM attempts
+    WHERE student_id = ? AND language = ? AND quiz_id = ?
+      AND COALESCE(question_id, 0) = ? AND COALESCE(question_slot, 0) = ?
+    ORDER BY id DESC LIMIT 1
+'''
+
+# Guarded so an attempt is credited at most once, however many workers race to learn from it.
+_SQL_UPDATE_IMPROVEMENT = (
+    'UPDATE attempts SET improved_vs_previous = ?, delta_score = ? '
+    'WHERE id = ? AND improved_vs_previous IS NULL'
+)
+
+_SQL_BUMP_HINT_STATS = '''
+    INSERT INTO hint_stats (language, cluster_key, hint_level, hint_variant, exposures, improvements, total_delta)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(language, cluster_key, hint_level, hint_variant)
+    DO UPDATE SET
+        exposures = exposures + excluded.exposures,
+        improvements = improvements + excluded.improvements,
+        total_delta = total_delta + excluded.total_delta,
+        updated_at = CURRENT_TIMESTAMP
+'''
+
+_SQL_GET_HINT_STATS = '''
+    SELECT * FROM hint_stats
+    WHERE language = ? AND cluster_key = ? AND hint_level = ?
+    ORDER BY exposures DESC, improvements DESC, total_delta DESC
+'''
 
-def get_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    conn.execute('PRAGMA journal_mode=WAL')
-    return conn
 
-
-def init_db() -> None:
-    with get_conn() as conn:
+def get_conn() -> sqlite3.Connection:
+    conn = getattr(_LOCAL, 'conn', None)
+    if conn is None:
+        # Autocommit: each statement is its own transaction unless wrapped explicitly.
+        conn = sqlite3.connect(DB_PATH, isolation_level=None)
+        conn.row_factory = sqlite3.Row
         conn.executescript(
             '''
-            CREATE TABLE IF NOT EXISTS attempts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                mode TEXT NOT NULL,
-                language TEXT NOT NULL,
-                course_id INTEGER,
-                quiz_id INTEGER,
-                question_id INTEGER,
-                question_slot INTEGER,
-                question_name TEXT,
-                student_id TEXT NOT NULL,
-                attempt_id INTEGER,
-                attempt_no INTEGER,
-                source_code TEXT,
-                source_hash TEXT,
-                score REAL,
-                max_score REAL,
-                compile_error_text TEXT,
-                runtime_error_text TEXT,
-                failed_tests_json TEXT,
-                full_feedback_text TEXT,
-                cluster_key TEXT,
-                hint_level INTEGER,
-                hint_type TEXT,
-                hint_variant TEXT,
-                hint_text TEXT,
-                confidence REAL,
-                improved_vs_previous INTEGER DEFAULT NULL,
-                delta_score REAL DEFAULT NULL
-            );
-
-            CREATE INDEX IF NOT EXISTS idx_attempts_student_q
-                ON attempts (student_id, language, quiz_id, question_id, question_slot, id);
-
-            CREATE TABLE IF NOT EXISTS hint_stats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                language TEXT NOT NULL,
-                cluster_key TEXT NOT NULL,
-                hint_level INTEGER NOT NULL,
-                hint_variant TEXT NOT NULL,
-                exposures INTEGER NOT NULL DEFAULT 0,
-                improvements INTEGER NOT NULL DEFAULT 0,
-                total_delta REAL NOT NULL DEFAULT 0,
-                updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(language, cluster_key, hint_level, hint_variant)
-            );
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA cache_size=-20000;
+            PRAGMA mmap_size=268435456;
             '''
         )
+        _LOCAL.conn = conn
+    return conn
+
+
+@contextmanager
+def transaction() -> Iterator[sqlite3.Connection]:
+    """Run the enclosed statements as one write transaction on this thread's connection."""
+    conn = get_conn()
+    depth = getattr(_LOCAL, 'tx_depth', 0)
+    if depth:
+        # Nested use joins the outer transaction.
+        _LOCAL.tx_depth = depth + 1
+        try:
+            yield conn
+        finally:
+            _LOCAL.tx_depth = depth
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    _LOCAL.tx_depth = 1
+    try:
+        yield conn
+        conn.execute('COMMIT')
+    except BaseException:
+        # A failed COMMIT can leave the transaction open; never let it leak into the next caller.
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        _LOCAL.tx_depth = 0
+
+
+def init_db() -> None:
+    conn = get_conn()
+    conn.executescript(
+        '''
+        CREATE TABLE IF NOT EXISTS attempts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            mode TEXT NOT NULL,
+            language TEXT NOT NULL,
+            course_id INTEGER,
+            quiz_id INTEGER,
+            question_id INTEGER,
+            question_slot INTEGER,
+            question_name TEXT,
+            student_id TEXT NOT NULL,
+            attempt_id INTEGER,
+            attempt_no INTEGER,
+            source_code TEXT,
+            source_hash TEXT,
+            score REAL,
+            max_score REAL,
+            compile_error_text TEXT,
+            runtime_error_text TEXT,
+            failed_tests_json TEXT,
+            full_feedback_text TEXT,
+            cluster_key TEXT,
+            hint_level INTEGER,
+            hint_type TEXT,
+            hint_variant TEXT,
+            hint_text TEXT,
+            confidence REAL,
+            improved_vs_previous INTEGER DEFAULT NULL,
+            delta_score REAL DEFAULT NULL
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_attempts_student_q
+            ON attempts (student_id, language, quiz_id, question_id, question_slot, id);
+
+        CREATE TABLE IF NOT EXISTS hint_stats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            language TEXT NOT NULL,
+            cluster_key TEXT NOT NULL,
+            hint_level INTEGER NOT NULL,
+            hint_variant TEXT NOT NULL,
+            exposures INTEGER NOT NULL DEFAULT 0,
+            improvements INTEGER NOT NULL DEFAULT 0,
+            total_delta REAL NOT NULL DEFAULT 0,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(language, cluster_key, hint_level, hint_variant)
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_hint_stats_lookup
+            ON hint_stats (language, cluster_key, hint_level, exposures DESC, improvements DESC, total_delta DESC);
+
+        CREATE INDEX IF NOT EXISTS idx_hint_stats_top
+            ON hint_stats (exposures DESC, improvements DESC);
+        '''
+    )
+    # ALTER TABLE can only add VIRTUAL generated columns; the index below materializes the value.
+    columns = {row['name'] for row in conn.execute('PRAGMA table_xinfo(hint_stats)')}
+    if 'improve_rate' not in columns:
+        conn.execute(f'ALTER TABLE hint_stats ADD COLUMN {_IMPROVE_RATE_COLUMN}')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_hint_stats_rate ON hint_stats (improve_rate DESC)')
 
 
 def _json_dumps(obj: Any) -> str:
-    return json.dumps(obj, ensure_ascii=False)
+    # Like ensure_ascii=False, non-ASCII text is kept as-is; separators are compact.
+    return orjson.dumps(obj).decode('utf-8')
 
 
-def insert_attempt(row: dict[str, Any]) -> int:
-    keys = list(row.keys())
-    placeholders = ', '.join('?' for _ in keys)
-    sql = f"INSERT INTO attempts ({', '.join(keys)}) VALUES ({placeholders})"
-    with get_conn() as conn:
-        cur = conn.execute(sql, [row[k] for k in keys])
-        return int(cur.lastrowid)
+def insert_attempt(row: dict[str, Any], *, conn: Optional[sqlite3.Connection] = None) -> int:
+    # Every column must be supplied (row[k] raises KeyError) and nothing else: a typo'd key fails loudly.
+    if not row.keys() <= _ATTEMPT_COLUMN_SET:
+        raise ValueError(f'Unknown attempt columns: {sorted(row.keys() - _ATTEMPT_COLUMN_SET)}')
+    cur = (conn or get_conn()).execute(_SQL_INSERT_ATTEMPT, [row[k] for k in ATTEMPT_COLUMNS])
+    return int(cur.lastrowid)
 
 
-def get_last_attempt_for_context(*, student_id: str, language: str, quiz_id: int, question_id: int, question_slot: int) -> Optional[sqlite3.Row]:
-    with get_conn() as conn:
-        cur = conn.execute(
-            '''
-            SELECT * FROM attempts
-            WHERE student_id = ? AND language = ? AND quiz_id = ?
-              AND COALESCE(question_id, 0) = ? AND COALESCE(question_slot, 0) = ?
-            ORDER BY id DESC LIMIT 1
-            ''',
-            (student_id, language, quiz_id, question_id, question_slot)
-        )
-        return cur.fetchone()
+def get_last_attempt_for_context(*, student_id: str, language: str, quiz_id: int, question_id: int, question_slot: int, conn: Optional[sqlite3.Connection] = None) -> Optional[sqlite3.Row]:
+    conn = conn or get_conn()
+    cur = conn.execute(_SQL_GET_LAST_ATTEMPT, (student_id, language, quiz_id, question_id, question_slot))
+    return cur.fetchone()
 
 
-def update_attempt_improvement(attempt_row_id: int, improved: bool, delta_score: float) -> None:
-    with get_conn() as conn:
-        conn.execute(
-            'UPDATE attempts SET improved_vs_previous = ?, delta_score = ? WHERE id = ?',
-            (1 if improved else 0, float(delta_score), attempt_row_id)
-        )
+def update_attempt_improvement(attempt_row_id: int, improved: bool, delta_score: float, *, conn: Optional[sqlite3.Connection] = None) -> bool:
+    """Record the outcome of an attempt's hint; False if it was already credited."""
+    conn = conn or get_conn()
+    cur = conn.execute(_SQL_UPDATE_IMPROVEMENT, (1 if improved else 0, float(delta_score), attempt_row_id))
+    return cur.rowcount == 1
 
 
-def bump_hint_stats(*, language: str, cluster_key: str, hint_level: int, hint_variant: str, exposure_inc: int = 0, improvement_inc: int = 0, delta_inc: float = 0.0) -> None:
-    with get_conn() as conn:
-        conn.execute(
-            '''
-            INSERT INTO hint_stats (language, cluster_key, hint_level, hint_variant, exposures, improvements, total_delta)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            ON CONFLICT(language, cluster_key, hint_level, hint_variant)
-            DO UPDATE SET
-                exposures = exposures + excluded.exposures,
-                improvements = improvements + excluded.improvements,
-                total_delta = total_delta + excluded.total_delta,
-                updated_at = CURRENT_TIMESTAMP
-            ''',
-            (language, cluster_key, hint_level, hint_variant, exposure_inc, improvement_inc, float(delta_inc))
-        )
+def bump_hint_stats(*, language: str, cluster_key: str, hint_level: int, hint_variant: str, exposure_inc: int = 0, improvement_inc: int = 0, delta_inc: float = 0.0, conn: Optional[sqlite3.Connection] = None) -> None:
+    conn = conn or get_conn()
+    conn.execute(
+        _SQL_BUMP_HINT_STATS,
+        (language, cluster_key, hint_level, hint_variant, exposure_inc, improvement_inc, float(delta_inc))
+    )
 
 
-def get_hint_stats(*, language: str, cluster_key: str, hint_level: int) -> list[sqlite3.Row]:
-    with get_conn() as conn:
-        cur = conn.execute(
-            '''
-            SELECT * FROM hint_stats
-            WHERE language = ? AND cluster_key = ? AND hint_level = ?
-            ORDER BY exposures DESC, improvements DESC, total_delta DESC
-            ''',
-            (language, cluster_key, hint_level)
-        )
-        return cur.fetchall()
+def get_hint_stats(*, language: str, cluster_key: str, hint_level: int, conn: Optional[sqlite3.Connection] = None) -> list[sqlite3.Row]:
+    conn = conn or get_conn()
+    cur = conn.execute(_SQL_GET_HINT_STATS, (language, cluster_key, hint_level))
+    return cur.fetchall()
 
 
 def json_text(obj: Any) -> str:
@@ -25,6 +25,13 @@ app.add_middleware(
 @app.on_event('startup')
 def _startup() -> None:
     db.init_db()
+    engine.start()
+
+
+@app.on_event('shutdown')
+def _shutdown() -> None:
+    # Commit hint attempts still queued for the background writer.
+    engine.close()
 
 
 def check_api_key(x_api_key: Optional[str] = Header(default=None)) -> None:
@@ -46,15 +53,13 @@ def hint(req: HintRequest) -> HintResponse:
 @app.get('/stats/top', dependencies=[Depends(check_api_key)])
 def stats_top(limit: int = 20) -> dict:
     # Lightweight admin endpoint for quick debugging.
-    with db.get_conn() as conn:
-        rows = conn.execute(
-            '''
-            SELECT language, cluster_key, hint_level, hint_variant, exposures, improvements, total_delta,
-                   ROUND(CAST(improvements AS REAL) / CASE WHEN exposures = 0 THEN 1 ELSE exposures END, 3) AS improve_rate
-            FROM hint_stats
-            ORDER BY exposures DESC, improvements DESC
-            LIMIT ?
-            ''',
-            (max(1, min(limit, 200)),)
-        ).fetchall()
+    rows = db.get_conn().execute(
+        '''
+        SELECT language, cluster_key, hint_level, hint_variant, exposures, improvements, total_delta, improve_rate
+        FROM hint_stats
+        ORDER BY exposures DESC, improvements DESC
+        LIMIT ?
+        ''',
+        (max(1, min(limit, 200)),)
+    ).fetchall()
     return {'items': [dict(r) for r in rows]}
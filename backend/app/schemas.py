@@ -1,10 +1,13 @@
 from __future__ import annotations
 
 from typing import Any, Optional
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 
 class CodeRunnerPayload(BaseModel):
+    # Plugins may send extra fields; drop them instead of storing them on the model.
+    model_config = ConfigDict(extra="ignore")
+
     score: float = 0.0
     max_score: float = 1.0
     compile_error_text: str = ""
@@ -14,6 +17,8 @@ class CodeRunnerPayload(BaseModel):
 
 
 class HintRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     mode: str = "training"  # training|exam
     language: str = "c"
     course_id: int = 0
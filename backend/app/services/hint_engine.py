@@ -1,24 +1,119 @@
 from __future__ import annotations
 
-import hashlib
-import json
-import random
+import logging
+import math
+import queue
+import sqlite3
+import threading
+import time
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable, Optional
+
+import orjson
+import xxhash
 
 from app import db
 from app.analyzers.c_adapter import CAdapter
 from app.schemas import HintRequest, HintResponse
 
+logger = logging.getLogger(__name__)
+
 CATALOG_DIR = Path(__file__).resolve().parent.parent / 'hint_catalog'
+FALLBACK_CLUSTER = 'c_logic_generic_failed_tests'
+# How long per-(language, cluster, level) variant stats are served from memory.
+STATS_CACHE_TTL_S = 30.0
+# How often the catalog file's mtime is rechecked for hot reload.
+CATALOG_RECHECK_S = 5.0
+HINT_LEVELS = (1, 2, 3)
+# Max queued persistence jobs committed together in one transaction.
+WRITE_BATCH_SIZE = 32
+# Bound on attempts remembered while queued (entries of failed writes are never cleared otherwise).
+PENDING_ATTEMPTS_MAX = 65536
+DEFAULT_HINT_TEXT = 'Controlla il primo test che fallisce e ripercorri il flusso con un input piccolo, concentrandoti su casi limite e gestione della memoria.'
 
 
 class HintEngine:
     def __init__(self) -> None:
         self._c_adapter = CAdapter()
-        self._catalog_cache: dict[str, dict[str, Any]] = {}
-        # Exploration rate for "learns by trying" hint variants.
-        self.epsilon = 0.15
+        # language -> (catalog, file mtime_ns or None if missing, last checked at)
+        self._catalog_cache: dict[str, tuple[dict[str, Any], Optional[int], float]] = {}
+        self._variants_by_cluster: dict[str, dict[str, tuple[str, ...]]] = {}
+        # language -> {(cluster_key, hint_variant, hint_level): text}, lower levels back-filled.
+        self._flat_catalog: dict[str, dict[tuple[str, str, int], str]] = {}
+        # (language, cluster_key, hint_level) -> ({variant: (exposures, improvements, total_delta)}, fetched_at)
+        self._stats_cache: dict[tuple[str, str, int], tuple[dict[str, tuple[int, int, float]], float]] = {}
+        # Serializes read-copy-store updates of _stats_cache across worker threads.
+        self._stats_lock = threading.Lock()
+        # (student_id, language, quiz_id, question_id, question_slot) -> this worker's newest attempt
+        # while it waits in the write queue. Only a hint for the hint level: crediting reads SQLite.
+        self._pending_attempts: dict[tuple[str, str, int, int, int], dict[str, Any]] = {}
+        # Guards _pending_attempts only; held for dict operations, never across I/O.
+        self._attempts_lock = threading.Lock()
+        # DB writes are drained by a single background writer; None asks it to stop.
+        # Each job returns a callback that runs once its transaction has committed.
+        self._write_q: queue.Queue[Optional[Callable[[sqlite3.Connection], Callable[[], None]]]] = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        # Serializes start/close against enqueues, so no job lands behind the stop marker.
+        self._writer_lock = threading.Lock()
+
+    def start(self) -> None:
+        """Start the background writer; a no-op if it is already running."""
+        with self._writer_lock:
+            if self._writer_running():
+                return
+            self._writer = threading.Thread(target=self._writer_loop, name='hint-db-writer', daemon=True)
+            self._writer.start()
+
+    def flush(self) -> None:
+        """Block until every queued write has been committed."""
+        if not self._writer_running():
+            # Nobody would ever drain the queue.
+            raise RuntimeError('Hint writer is not running')
+        self._write_q.join()
+
+    def close(self) -> None:
+        """Commit pending writes and stop the writer thread; start() may run it again."""
+        with self._writer_lock:
+            if not self._writer_running():
+                return
+            self._write_q.put(None)
+            self._writer.join()
+            self._writer = None
+
+    def _writer_running(self) -> bool:
+        return self._writer is not None and self._writer.is_alive()
+
+    def _writer_loop(self) -> None:
+        while True:
+            batch = [self._write_q.get()]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self._write_q.get_nowait())
+                except queue.Empty:
+                    break
+            jobs = [job for job in batch if job is not None]
+            try:
+                self._run_jobs(jobs)
+            finally:
+                for _ in batch:
+                    self._write_q.task_done()
+            if len(jobs) < len(batch):
+                return
+
+    def _run_jobs(self, jobs: list[Callable[[sqlite3.Connection], Callable[[], None]]]) -> None:
+        try:
+            with db.transaction() as cx:
+                on_commit = [job(cx) for job in jobs]
+        except Exception:
+            if len(jobs) == 1:
+                logger.exception('Failed to persist hint attempt')
+                return
+            # One bad job rolled back the batch: retry individually so the rest still land.
+            for job in jobs:
+                self._run_jobs([job])
+            return
+        for callback in on_commit:
+            callback()
 
     def handle_hint(self, req: HintRequest) -> HintResponse:
         if req.mode != 'training':
@@ -37,85 +132,144 @@ class HintEngine:
                 hint_variant='default'
             )
 
-        analysis = self._c_adapter.analyze(req)
-        cluster_key = analysis.cluster_key
-        hint_type = analysis.hint_type
-        confidence = analysis.confidence
+        # Non-cryptographic fingerprint for dedup; xxh3_64 gives exactly 16 hex chars.
+        source_hash = xxhash.xxh3_64((req.source_code or '').encode('utf-8', errors='ignore')).hexdigest()
+
+        cluster_key, hint_type, confidence = self._c_adapter.analyze(req, source_hash=source_hash)
 
+        self._load_catalog(language)
+
+        context = (req.student_id, language, req.quiz_id, req.question_id, req.question_slot)
         # Decide hint level based on prior attempts for same student/question context.
-        previous = db.get_last_attempt_for_context(
-            student_id=req.student_id,
-            language=language,
-            quiz_id=req.quiz_id,
-            question_id=req.question_id,
-            question_slot=req.question_slot,
-        )
+        # Our own queued attempt is newer than anything committed, so it wins over SQLite.
+        # Read without removing it: if anything below fails, the entry must still be there.
+        previous = self._pending_attempts.get(context)
+        if previous is None:
+            stored = db.get_last_attempt_for_context(
+                student_id=req.student_id,
+                language=language,
+                quiz_id=req.quiz_id,
+                question_id=req.question_id,
+                question_slot=req.question_slot,
+            )
+            previous = dict(stored) if stored is not None else None
 
-        # Learn from the previous hint effectiveness when current attempt arrives.
+        # Report the previous hint's effectiveness; the writer does the actual crediting.
         learning_info: dict[str, Any] = {}
         if previous is not None and previous['hint_variant'] and previous['hint_level']:
-            prevscore = float(previous['score'] or 0.0)
-            currscore = float(req.coderunner.score or 0.0)
-            delta = currscore - prevscore
-            improved = delta > 1e-9
-            db.update_attempt_improvement(int(previous['id']), improved, delta)
-            db.bump_hint_stats(
-                language=str(previous['language']),
-                cluster_key=str(previous['cluster_key'] or 'unknown'),
-                hint_level=int(previous['hint_level'] or 1),
-                hint_variant=str(previous['hint_variant'] or 'default'),
-                exposure_inc=0,
-                improvement_inc=1 if improved else 0,
-                delta_inc=delta,
-            )
+            delta = float(req.coderunner.score or 0.0) - float(previous['score'] or 0.0)
             learning_info = {
-                'previous_hint_improved_score': improved,
+                'previous_hint_improved_score': delta > 1e-9,
                 'previous_delta_score': round(delta, 4)
             }
 
         hint_level = self._decide_level(previous)
-        catalog = self._load_catalog(language)
-        hint_variant = self._choose_variant(language, cluster_key, hint_level, catalog)
-        hint_text = self._resolve_hint_text(catalog, cluster_key, hint_level, hint_variant)
-
-        # Count exposure of selected hint.
-        db.bump_hint_stats(
-            language=language,
-            cluster_key=cluster_key,
-            hint_level=hint_level,
-            hint_variant=hint_variant,
-            exposure_inc=1,
-            improvement_inc=0,
-            delta_inc=0.0,
-        )
+        hint_variant = self._choose_variant(language, cluster_key, hint_level)
+        hint_text = self._resolve_hint_text(language, cluster_key, hint_level, hint_variant)
 
-        source_hash = hashlib.sha256((req.source_code or '').encode('utf-8', errors='ignore')).hexdigest()[:16]
-        db.insert_attempt({
-            'mode': req.mode,
+        attempt: dict[str, Any] = {
             'language': language,
-            'course_id': req.course_id,
-            'quiz_id': req.quiz_id,
-            'question_id': req.question_id,
-            'question_slot': req.question_slot,
-            'question_name': req.question_name,
-            'student_id': req.student_id,
-            'attempt_id': req.attempt_id,
-            'attempt_no': req.attempt_no,
-            'source_code': req.source_code,
-            'source_hash': source_hash,
-            'score': req.coderunner.score,
-            'max_score': req.coderunner.max_score,
-            'compile_error_text': req.coderunner.compile_error_text,
-            'runtime_error_text': req.coderunner.runtime_error_text,
-            'failed_tests_json': db.json_text(req.coderunner.failed_tests),
-            'full_feedback_text': req.coderunner.full_feedback_text,
             'cluster_key': cluster_key,
             'hint_level': hint_level,
-            'hint_type': hint_type,
             'hint_variant': hint_variant,
-            'hint_text': hint_text,
-            'confidence': confidence,
-        })
+            'score': req.coderunner.score,
+            'max_score': req.coderunner.max_score,
+        }
+
+        def persist(cx: sqlite3.Connection) -> Callable[[], None]:
+            # Learn from the previous hint effectiveness when current attempt arrives.
+            # Read inside the write transaction so every worker sees the same "previous" row;
+            # the guarded update makes sure it is credited only once.
+            credited: Optional[tuple[tuple[str, str, int], str, bool, float]] = None
+            prev = db.get_last_attempt_for_context(
+                student_id=req.student_id,
+                language=language,
+                quiz_id=req.quiz_id,
+                question_id=req.question_id,
+                question_slot=req.question_slot,
+                conn=cx,
+            )
+            if prev is not None and prev['hint_variant'] and prev['hint_level']:
+                delta = float(req.coderunner.score or 0.0) - float(prev['score'] or 0.0)
+                improved = delta > 1e-9
+                if db.update_attempt_improvement(int(prev['id']), improved, delta, conn=cx):
+                    prev_key = (str(prev['language']), str(prev['cluster_key'] or 'unknown'), int(prev['hint_level'] or 1))
+                    prev_variant = str(prev['hint_variant'] or 'default')
+                    db.bump_hint_stats(
+                        language=prev_key[0],
+                        cluster_key=prev_key[1],
+                        hint_level=prev_key[2],
+                        hint_variant=prev_variant,
+                        exposure_inc=0,
+                        improvement_inc=1 if improved else 0,
+                        delta_inc=delta,
+                        conn=cx,
+                    )
+                    credited = (prev_key, prev_variant, improved, delta)
+
+            # Count exposure of selected hint.
+            db.bump_hint_stats(
+                language=language,
+                cluster_key=cluster_key,
+                hint_level=hint_level,
+                hint_variant=hint_variant,
+                exposure_inc=1,
+                improvement_inc=0,
+                delta_inc=0.0,
+                conn=cx,
+            )
+
+            db.insert_attempt({
+                'mode': req.mode,
+                'language': language,
+                'course_id': req.course_id,
+                'quiz_id': req.quiz_id,
+                'question_id': req.question_id,
+                'question_slot': req.question_slot,
+                'question_name': req.question_name,
+                'student_id': req.student_id,
+                'attempt_id': req.attempt_id,
+                'attempt_no': req.attempt_no,
+                'source_code': req.source_code,
+                'source_hash': source_hash,
+                'score': req.coderunner.score,
+                'max_score': req.coderunner.max_score,
+                'compile_error_text': req.coderunner.compile_error_text,
+                'runtime_error_text': req.coderunner.runtime_error_text,
+                'failed_tests_json': db.json_text(req.coderunner.failed_tests),
+                'full_feedback_text': req.coderunner.full_feedback_text,
+                'cluster_key': cluster_key,
+                'hint_level': hint_level,
+                'hint_type': hint_type,
+                'hint_variant': hint_variant,
+                'hint_text': hint_text,
+                'confidence': confidence,
+            }, conn=cx)
+
+            def committed() -> None:
+                # SQLite has the attempt now: stop overriding it unless a newer one replaced it.
+                with self._attempts_lock:
+                    if self._pending_attempts.get(context) is attempt:
+                        del self._pending_attempts[context]
+                if credited is not None:
+                    prev_key, prev_variant, improved, delta = credited
+                    self._note_stats(prev_key, prev_variant, 0, 1 if improved else 0, delta)
+
+            return committed
+
+        with self._writer_lock:
+            if not self._writer_running():
+                # Refuse rather than queue a write that would silently never happen.
+                raise RuntimeError('Hint writer is not running')
+            with self._attempts_lock:
+                if len(self._pending_attempts) >= PENDING_ATTEMPTS_MAX:
+                    # Dicts keep insertion order: drop the oldest entry.
+                    del self._pending_attempts[next(iter(self._pending_attempts))]
+                self._pending_attempts[context] = attempt
+            # Persistence is fire-and-forget: the student only waits for the hint text.
+            self._write_q.put(persist)
+        # Last, so a request that fails above leaves the cached stats untouched.
+        self._note_stats((language, cluster_key, hint_level), hint_variant, 1, 0, 0.0)
 
         return HintResponse(
             enabled=True,
@@ -145,56 +299,103 @@ class HintEngine:
         return min(3, max(1, prevlevel + 1))
 
     def _load_catalog(self, language: str) -> dict[str, Any]:
-        if language in self._catalog_cache:
-            return self._catalog_cache[language]
+        now = time.monotonic()
+        cached = self._catalog_cache.get(language)
+        if cached is not None and now - cached[2] < CATALOG_RECHECK_S:
+            return cached[0]
         path = CATALOG_DIR / f'{language}.json'
-        if not path.exists():
-            self._catalog_cache[language] = {}
-            return {}
-        self._catalog_cache[language] = json.loads(path.read_text(encoding='utf-8'))
-        return self._catalog_cache[language]
-
-    def _choose_variant(self, language: str, cluster_key: str, hint_level: int, catalog: dict[str, Any]) -> str:
-        entry = catalog.get(cluster_key) or catalog.get('c_logic_generic_failed_tests') or {}
-        variants = list((entry.get('variants') or {}).keys()) or ['default']
+        try:
+            mtime_ns: Optional[int] = path.stat().st_mtime_ns
+        except FileNotFoundError:
+            mtime_ns = None
+        if cached is not None and cached[1] == mtime_ns:
+            self._catalog_cache[language] = (cached[0], mtime_ns, now)
+            return cached[0]
+        catalog: dict[str, Any] = {}
+        if mtime_ns is not None:
+            try:
+                catalog = orjson.loads(path.read_bytes())
+            except orjson.JSONDecodeError:
+                # Likely caught mid-edit: keep serving the previous catalog and retry later.
+                if cached is None:
+                    raise
+                self._catalog_cache[language] = (cached[0], cached[1], now)
+                return cached[0]
+        self._variants_by_cluster[language] = {
+            cluster: tuple((entry.get('variants') or {}).keys())
+            for cluster, entry in catalog.items() if entry
+        }
+        self._flat_catalog[language] = self._flatten_catalog(catalog)
+        self._catalog_cache[language] = (catalog, mtime_ns, now)
+        return catalog
+
+    def _choose_variant(self, language: str, cluster_key: str, hint_level: int) -> str:
+        by_cluster = self._variants_by_cluster.get(language, {})
+        variants = by_cluster.get(cluster_key)
+        if variants is None:
+            variants = by_cluster.get(FALLBACK_CLUSTER)
+        variants = variants or ('default',)
         if len(variants) == 1:
             return variants[0]
 
-        if random.random() < self.epsilon:
-            return random.choice(variants)
-
-        stats = db.get_hint_stats(language=language, cluster_key=cluster_key, hint_level=hint_level)
-        score_by_variant: dict[str, float] = {}
-        for row in stats:
-            v = str(row['hint_variant'])
-            exp = int(row['exposures'] or 0)
-            imp = int(row['improvements'] or 0)
-            total_delta = float(row['total_delta'] or 0.0)
-            # Conservative score = success rate + tiny delta bonus; optimistic for low data via prior.
-            rate = (imp + 1.0) / (exp + 2.0)
-            score_by_variant[v] = rate + (0.05 * total_delta / max(1.0, exp))
-
-        # Prefer variants with no data occasionally to bootstrap.
-        unseen = [v for v in variants if v not in score_by_variant]
-        if unseen:
-            return random.choice(unseen)
-
-        variants_sorted = sorted(variants, key=lambda v: score_by_variant.get(v, 0.0), reverse=True)
-        return variants_sorted[0]
-
-    def _resolve_hint_text(self, catalog: dict[str, Any], cluster_key: str, hint_level: int, hint_variant: str) -> str:
-        fallback = catalog.get('c_logic_generic_failed_tests', {})
-        entry = catalog.get(cluster_key, fallback)
-        variants = entry.get('variants', {})
-        chosen = variants.get(hint_variant) or (next(iter(variants.values())) if variants else None)
-        if not chosen:
-            return 'Controlla il primo test che fallisce e ripercorri il flusso con un input piccolo, concentrandoti su casi limite e gestione della memoria.'
-        txt = chosen.get(str(hint_level))
-        if txt:
-            return txt
-        # Graceful fallback to lower levels.
-        for level in range(hint_level, 0, -1):
-            txt = chosen.get(str(level))
-            if txt:
-                return txt
-        return 'Controlla il primo test che fallisce e ripercorri il flusso con un input piccolo, concentrandoti su casi limite e gestione della memoria.'
+        stats = self._get_stats((language, cluster_key, hint_level))
+        # UCB1 ("learns by trying"): untried variants go first, then the best
+        # optimistic score = success rate + tiny delta bonus + exploration bonus.
+        log_total = math.log(max(1, sum(stats.get(v, (0, 0, 0.0))[0] for v in variants)))
+
+        def ucb(v: str) -> float:
+            exp, imp, total_delta = stats.get(v, (0, 0, 0.0))
+            if exp <= 0:
+                return math.inf
+            rate = (imp + 1.0) / (exp + 2.0) + (0.05 * total_delta / exp)
+            return rate + math.sqrt(2.0 * log_total / exp)
+
+        return max(variants, key=ucb)
+
+    def _get_stats(self, key: tuple[str, str, int]) -> dict[str, tuple[int, int, float]]:
+        cached = self._stats_cache.get(key)
+        now = time.monotonic()
+        if cached is not None and now - cached[1] < STATS_CACHE_TTL_S:
+            return cached[0]
+        language, cluster_key, hint_level = key
+        rows = db.get_hint_stats(language=language, cluster_key=cluster_key, hint_level=hint_level)
+        stats = {
+            str(row['hint_variant']): (int(row['exposures'] or 0), int(row['improvements'] or 0), float(row['total_delta'] or 0.0))
+            for row in rows
+        }
+        with self._stats_lock:
+            self._stats_cache[key] = (stats, now)
+        return stats
+
+    def _note_stats(self, key: tuple[str, str, int], hint_variant: str, exposure_inc: int, improvement_inc: int, delta_inc: float) -> None:
+        # Write-through for our own bumps; other workers' writes show up once the TTL expires.
+        with self._stats_lock:
+            cached = self._stats_cache.get(key)
+            if cached is None:
+                return
+            # Copy-on-write so lock-free readers never see the dict change under them.
+            stats = dict(cached[0])
+            exp, imp, total_delta = stats.get(hint_variant, (0, 0, 0.0))
+            stats[hint_variant] = (exp + exposure_inc, imp + improvement_inc, total_delta + delta_inc)
+            self._stats_cache[key] = (stats, cached[1])
+
+    def _flatten_catalog(self, catalog: dict[str, Any]) -> dict[tuple[str, str, int], str]:
+        flat: dict[tuple[str, str, int], str] = {}
+        for cluster_key, entry in catalog.items():
+            for hint_variant, by_level in ((entry or {}).get('variants') or {}).items():
+                text = None
+                for level in HINT_LEVELS:
+                    # Graceful fallback to lower levels.
+                    text = (by_level or {}).get(str(level)) or text
+                    if text:
+                        flat[(cluster_key, hint_variant, level)] = text
+        return flat
+
+    def _resolve_hint_text(self, language: str, cluster_key: str, hint_level: int, hint_variant: str) -> str:
+        flat = self._flat_catalog.get(language, {})
+        # Clusters missing from the catalog get their variant from the fallback cluster.
+        return (
+            flat.get((cluster_key, hint_variant, hint_level))
+            or flat.get((FALLBACK_CLUSTER, hint_variant, hint_level))
+            or DEFAULT_HINT_TEXT
+        )